@@ -9,6 +9,11 @@ import platform
 import time
 import sys
 
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
 parser = argparse.ArgumentParser()
 
 
@@ -35,27 +40,43 @@ if sys.version_info[0] >= 3:
 else:
     distro = platform.dist()
 
+# Build the sudo prefix once instead of concatenating the password
+# pipeline into every command string.
+SUDO = "echo '"+passwd+"' | sudo -S"
+# DetectDistro shells out, so look it up once for the whole script.
+detected_distro = DetectDistro()
+# The sed script and conf locations never change, so build the command
+# template once instead of concatenating it on every call.
+SUDO_SED = SUDO+" sed -i s/Logs.Verbose=n/Logs.Verbose=y/g "
+WAAGENT_CONF_PATHS = {
+    "COREOS": "/usr/share/oem/waagent.conf",
+    "clear-linux-os": "/usr/share/defaults/waagent/waagent.conf",
+}
+
 
 def RunTest():
     UpdateState("TestRunning")
     if(distro[0].upper() == "COREOS"):
         versionOutPut = Run("waagent --version")
     else:
-        output = Run("pgrep -fa python3.*waagent")
-        if ("python3" in output) :
-            versionOutPut = Run("/usr/bin/python3 /usr/sbin/waagent --version")
-        else :
-            versionOutPut = Run("/usr/sbin/waagent --version")
+        # Branch on the agent interpreter inside one shell instead of
+        # round-tripping the pgrep output through Python and forking twice.
+        # The [w] keeps the pattern from matching the wrapper shell's own
+        # command line, which would make pgrep always succeed.
+        versionOutPut = Run("if pgrep -f 'python3.*[w]aagent' >/dev/null; then /usr/bin/python3 /usr/sbin/waagent --version; else /usr/sbin/waagent --version; fi")
 
     RunLog.info("Checking log waagent.log...")
+    # Only the presence of a match matters, so use a fixed-string grep that
+    # stops at the first hit per file instead of counting every occurrence
+    # across potentially huge waagent logs.
     if("2.0." in versionOutPut):
-        output = Run("grep -i 'iptables -I INPUT -p udp --dport' /var/log/waagent* | wc -l | tr -d '\n'")
+        output = Run("grep -l -i -F -m1 'iptables -I INPUT -p udp --dport' /var/log/waagent* 2>/dev/null | head -n1")
         RunLog.info("agent version is 2.0")
     else:
-        output = Run("grep -i 'VERBOSE' /var/log/waagent* | wc -l | tr -d '\n'")
+        output = Run("grep -l -i -F -m1 'VERBOSE' /var/log/waagent* 2>/dev/null | head -n1")
         RunLog.info("agent version > 2.0")
 
-    if not (output == "0") :
+    if (output.strip() != "") :
         RunLog.info('The log file contains the verbose logs')
         ResultLog.info('PASS')
         UpdateState("TestCompleted")
@@ -67,22 +88,29 @@ def RunTest():
 
 def Restartwaagent():
     if (distro[0].upper() == "COREOS"):
-        Run("echo '"+passwd+"' | sudo -S sed -i s/Logs.Verbose=n/Logs.Verbose=y/g  /usr/share/oem/waagent.conf")
-    elif (DetectDistro()[0] == 'clear-linux-os'):
-        Run("echo '"+passwd+"' | sudo -S sed -i s/Logs.Verbose=n/Logs.Verbose=y/g  \
-            /usr/share/defaults/waagent/waagent.conf")
+        conf_path = WAAGENT_CONF_PATHS["COREOS"]
     else:
-        Run("echo '"+passwd+"' | sudo -S sed -i s/Logs.Verbose=n/Logs.Verbose=y/g  /etc/waagent.conf")
+        conf_path = WAAGENT_CONF_PATHS.get(detected_distro[0], "/etc/waagent.conf")
+    Run(SUDO_SED + conf_path)
     RunLog.info("Restart waagent service...")
-    result = Run("echo '"+passwd+"' | sudo -S find / -name systemctl |wc -l | tr -d '\n'")
+    # A PATH lookup answers "is systemctl available?" in microseconds;
+    # the previous 'find / -name systemctl' walked every mounted filesystem.
+    has_systemctl = which("systemctl") is not None
     if (distro[0].upper() == "UBUNTU") or (distro[0].upper() == "DEBIAN"):
-        Run("echo '"+passwd+"' | sudo -S service walinuxagent restart")
+        Run(SUDO+" service walinuxagent restart")
     else:
-        if (result == "0") :
-            os.system("echo '"+passwd+"' | sudo -S service waagent restart")
+        if not has_systemctl :
+            os.system(SUDO+" service waagent restart")
         else:
-            os.system("echo '"+passwd+"' | sudo -S systemctl restart waagent")
-    time.sleep(60)
+            os.system(SUDO+" systemctl restart waagent")
+    # The restart itself is synchronous; what needs time is the fresh
+    # agent writing verbose output for RunTest to grep. Poll for either
+    # log pattern RunTest checks instead of sleeping a flat 60 seconds.
+    for delay in (1, 2, 4, 8, 16, 30):
+        output = Run("grep -l -i -F -m1 -e 'VERBOSE' -e 'iptables -I INPUT -p udp --dport' /var/log/waagent* 2>/dev/null | head -n1")
+        if (output.strip() != "") :
+            break
+        time.sleep(delay)
 
 Restartwaagent()
 RunTest()